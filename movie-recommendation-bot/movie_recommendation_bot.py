@@ -1,9 +1,16 @@
+import io
 import os
-import requests
+import time
+import sqlite3
+import hashlib
+import asyncio
+import aiohttp
+import orjson
+from urllib.parse import urlsplit, parse_qsl, urlencode
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from functools import lru_cache
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -15,7 +22,7 @@ from telegram.ext import (
     PollHandler
 )
 from dotenv import load_dotenv
-import time
+from cachetools import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -23,13 +30,15 @@ TMDB_API_KEY = os.getenv('TMDB_API_KEY')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TMDB_API_KEY or not TELEGRAM_BOT_TOKEN:
     raise ValueError("TMDB_API_KEY or TELEGRAM_BOT_TOKEN not found in .env file")
+# Optional Telegram user ID allowed to use /refresh
+ADMIN_USER_ID = os.getenv('ADMIN_USER_ID')
 
 # Set up TMDb API
 def get_current_and_next_month():
     """Return list of current and next month in YYYY-MM format."""
     today = datetime.now()
     current_month = today.strftime('%Y-%m')
-    next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1).strftime('%Y-%m')
+    next_month = (today.replace(day=1) + relativedelta(months=1)).strftime('%Y-%m')
     return [current_month, next_month]
 
 def get_fallback_months(months_back=6):
@@ -37,7 +46,7 @@ def get_fallback_months(months_back=6):
     today = datetime.now()
     months = []
     for i in range(-months_back, 2):  # From `months_back` ago to next month
-        month = (today.replace(day=1) + timedelta(days=32 * i)).replace(day=1).strftime('%Y-%m')
+        month = (today.replace(day=1) + relativedelta(months=i)).strftime('%Y-%m')
         months.append(month)
     return months
 
@@ -55,95 +64,213 @@ COUNTRY_MAP = {
     'united states': 'US', 'united states of america': 'US'
 }
 
+# Columns stored in movies.feather
+MOVIE_COLUMNS = ['title', 'year', 'rating', 'genre', 'released', 'language', 'country']
+# Columns a cached file must have to be used, and that recommendations need
+_REQUIRED_COLS = frozenset({'title', 'rating', 'language', 'country', 'released'})
+_RECOMMENDATION_COLS = frozenset({'title', 'rating'})
+# Low-cardinality code columns are stored as categoricals (dictionary-encoded by
+# Arrow on disk) so filters compare int codes
+MOVIE_DTYPES = {'title': 'string', 'genre': 'string', 'language': 'category', 'country': 'category'}
+
+# On-disk cache for raw TMDb responses
+HTTP_CACHE_FILE = 'tmdb_cache.sqlite'
+HTTP_CACHE_TTL = 24 * 60 * 60  # 24 hours
+
+# Retry policy for transient TMDb failures
+MAX_RETRIES = 4
+BACKOFF_FACTOR = 0.5  # Waits 0.5s, 1s, 2s, 4s
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
 # Conversation states
 LANGUAGE, COUNTRY = range(2)
 
-# Global poll-to-chat mapping
-poll_id_to_chat_id = {}
+# Global poll-to-chat mapping, expiring after Telegram's 7-day maximum poll lifetime
+poll_id_to_chat_id = TTLCache(maxsize=10000, ttl=7 * 24 * 60 * 60)
+
+@lru_cache(maxsize=4096)
+def _month_key(released_date):
+    """Return the YYYY-MM part of a TMDb YYYY-MM-DD date, or None if malformed."""
+    if isinstance(released_date, str) and len(released_date) == 10 and released_date[4] == released_date[7] == '-':
+        return released_date[:7]
+    return None
 
 def is_target_month(released_date, target_months):
-    """Check if released_date is in target months (YYYY-MM format)."""
+    """Check if released_date is in target months (a frozenset of YYYY-MM strings)."""
+    return _month_key(released_date) in target_months
+
+_http_cache = None
+
+def get_http_cache():
+    """Open (once) the SQLite database holding cached TMDb responses."""
+    global _http_cache
+    if _http_cache is None:
+        _http_cache = sqlite3.connect(HTTP_CACHE_FILE)
+        _http_cache.execute(
+            'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, fetched_at REAL, body BLOB)'
+        )
+    return _http_cache
+
+def http_cache_key(url):
+    """Hash a TMDb URL into a cache key, ignoring the api_key parameter."""
+    parts = urlsplit(url)
+    params = [(k, v) for k, v in parse_qsl(parts.query) if k != 'api_key']
+    return hashlib.blake2b(f"{parts.path}?{urlencode(sorted(params))}".encode()).hexdigest()
+
+async def get_tmdb_json(session, url, force_refresh=False):
+    """GET a TMDb URL as JSON, serving it from the on-disk cache when fresh.
+
+    Transient failures (429/5xx, timeouts, bad JSON) are retried with exponential
+    backoff, honoring Retry-After on 429.
+    """
+    cache = get_http_cache()
+    key = http_cache_key(url)
+    if not force_refresh:
+        row = cache.execute('SELECT fetched_at, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row and time.time() - row[0] < HTTP_CACHE_TTL:
+            return orjson.loads(row[1])
+
+    for attempt in range(MAX_RETRIES + 1):
+        delay = BACKOFF_FACTOR * (2 ** attempt)
+        try:
+            async with session.get(url, timeout=REQUEST_TIMEOUT) as r:
+                body = await r.read()
+                status = r.status
+                if status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    retry_after = r.headers.get('Retry-After')
+                    if status == 429 and retry_after and retry_after.isdigit():
+                        delay = int(retry_after)
+                    raise aiohttp.ClientResponseError(r.request_info, r.history, status=status)
+            data = orjson.loads(body)
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"Request failed ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+    if status == 200:
+        cache.execute(
+            'INSERT OR REPLACE INTO responses (key, fetched_at, body) VALUES (?, ?, ?)',
+            (key, time.time(), body)
+        )
+        cache.commit()
+    return data
+
+# Parsed movies.feather, keyed by its mtime so a rewrite invalidates it
+_DF_CACHE = {}
+
+def load_cached_movies(cache_file):
+    """Return the parsed cache file, re-reading it only when its mtime changes."""
+    mtime = os.path.getmtime(cache_file)
+    if mtime not in _DF_CACHE:
+        _DF_CACHE.clear()
+        _DF_CACHE[mtime] = pd.read_feather(cache_file)
+    return _DF_CACHE[mtime]
+
+_tmdb_session = None
+
+def get_tmdb_session():
+    """Return the shared TMDb ClientSession, creating it on first use."""
+    global _tmdb_session
+    if _tmdb_session is None or _tmdb_session.closed:
+        # Keep-alive pool reuses TLS connections and DNS lookups across /recommend calls
+        connector = aiohttp.TCPConnector(limit=10, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60)
+        # TMDb serves gzip when asked; aiohttp decompresses transparently
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
+        _tmdb_session = aiohttp.ClientSession(connector=connector, headers=headers)
+    return _tmdb_session
+
+async def close_tmdb_session(app):
+    """Close the shared TMDb session on bot shutdown."""
+    if _tmdb_session is not None:
+        await _tmdb_session.close()
+
+# TMDb genre id -> name, loaded once from /genre/movie/list
+GENRE_ID_TO_NAME = {}
+
+async def load_genre_names(session, force_refresh=False):
+    """Populate GENRE_ID_TO_NAME from TMDb if it hasn't been loaded yet."""
+    if GENRE_ID_TO_NAME and not force_refresh:
+        return GENRE_ID_TO_NAME
+    url = f'https://api.themoviedb.org/3/genre/movie/list?api_key={TMDB_API_KEY}&language=en'
+    response = await get_tmdb_json(session, url, force_refresh)
+    GENRE_ID_TO_NAME.update({g['id']: g['name'] for g in response.get('genres', [])})
+    print(f"Loaded {len(GENRE_ID_TO_NAME)} TMDb genres")
+    return GENRE_ID_TO_NAME
+
+async def preload_genre_names(app):
+    """Fetch the static genre table once at bot startup."""
     try:
-        release = datetime.strptime(released_date, '%Y-%m-%d')
-        return release.strftime('%Y-%m') in target_months
-    except (ValueError, TypeError):
-        return False
+        await load_genre_names(get_tmdb_session())
+    except Exception as e:
+        print(f"Error preloading /genre/movie/list: {e}")
 
-def fetch_movie_data(language=None, country=None, use_fallback=False):
-    """Fetch movies from TMDb with filters and save to movies.csv."""
+async def fetch_movie_data(language_code='en', region_code='US', use_fallback=False, force_refresh=False):
+    """Fetch movies from TMDb with filters and save to movies.feather.
+
+    language_code and region_code are the ISO codes resolved from the user's
+    input (e.g. 'en', 'US'). Pass force_refresh=True to skip both movies.feather and the TMDb response cache.
+    """
     print("Fetching movie data...")
-    target_months = FALLBACK_MONTHS if use_fallback else INITIAL_MONTHS
-    cache_file = 'movies.csv'
+    target_months = frozenset(FALLBACK_MONTHS if use_fallback else INITIAL_MONTHS)
+    cache_file = 'movies.feather'
 
     # Check cached data
-    if os.path.exists(cache_file):
-        df = pd.read_csv(cache_file)
-        if not df.empty and all(col in df.columns for col in ['title', 'rating', 'language', 'country', 'released']):
-            print(f"Using cached movies.csv with {len(df)} movies")
-            if language:
-                df = df[df['language'].str.lower().str.contains(language.lower(), na=False)]
-            if country:
-                df = df[df['country'].str.lower().str.contains(country.lower(), na=False)]
-            df = df[df['released'].apply(lambda x: is_target_month(x, target_months))]
+    if not force_refresh and os.path.exists(cache_file):
+        df = load_cached_movies(cache_file)
+        if not df.empty and _REQUIRED_COLS.issubset(df.columns):
+            print(f"Using cached movies.feather with {len(df)} movies")
+            # Cached language/country are the ISO codes the rows were queried with, e.g. 'EN', 'US'
+            df = df[df['language'].eq(language_code.upper()) & df['country'].eq(region_code)]
+            released_months = pd.to_datetime(df['released'], format='%Y-%m-%d', errors='coerce').dt.strftime('%Y-%m')
+            df = df.loc[released_months.isin(target_months)]
             if len(df) >= 4:
                 return df
 
     data = []
     page = 1
     max_pages = 2  # Limit to 40 movies
-    language_code = LANGUAGE_MAP.get(language.lower() if language else '', 'en')
-    region_code = COUNTRY_MAP.get(country.lower() if country else '', 'US')
     
     # Dynamic date range for API query
     if use_fallback:
-        start_date = (datetime.now().replace(day=1) - timedelta(days=30 * 6)).replace(day=1).strftime('%Y-%m-%d')
+        start_date = (datetime.now().replace(day=1) - relativedelta(months=6)).strftime('%Y-%m-%d')
         # Last day of next month
-        end_date = (datetime.now().replace(day=1) + timedelta(days=32)).replace(day=1)
-        end_date = (end_date + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-        end_date = end_date.strftime('%Y-%m-%d')
+        end_date = (datetime.now().replace(day=1) + relativedelta(months=2, days=-1)).strftime('%Y-%m-%d')
     else:
         start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
         # Last day of next month
-        end_date = (datetime.now().replace(day=1) + timedelta(days=32)).replace(day=1)
-        end_date = (end_date + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-        end_date = end_date.strftime('%Y-%m-%d')
+        end_date = (datetime.now().replace(day=1) + relativedelta(months=2, days=-1)).strftime('%Y-%m-%d')
 
+    session = get_tmdb_session()
+    try:
+        genre_names = await load_genre_names(session, force_refresh)
+    except Exception as e:
+        print(f"Error fetching /genre/movie/list: {e}")
+        genre_names = {}
+    # with_original_language and with_origin_country enforce language/country server-side
     while len(data) < 20 and page <= max_pages:
-        url = f'https://api.themoviedb.org/3/discover/movie?api_key={TMDB_API_KEY}&language={language_code}®ion={region_code}&primary_release_date.gte={start_date}&primary_release_date.lte={end_date}&with_original_language={language_code}&page={page}'
+        url = f'https://api.themoviedb.org/3/discover/movie?api_key={TMDB_API_KEY}&language={language_code}&region={region_code}&primary_release_date.gte={start_date}&primary_release_date.lte={end_date}&with_original_language={language_code}&with_origin_country={region_code}&page={page}'
         try:
-            response = requests.get(url).json()
+            response = await get_tmdb_json(session, url, force_refresh)
             print(f"Page {page} response: {'success' if 'results' in response else response.get('status_message', 'error')}")
             movies = response.get('results', [])
             print(f"Found {len(movies)} movies on page {page}")
             for movie in movies:
-                try:
-                    released = movie.get('release_date', '')
-                    if is_target_month(released, target_months):
-                        detail_url = f'https://api.themoviedb.org/3/movie/{movie["id"]}?api_key={TMDB_API_KEY}&language={language_code}'
-                        detail_response = requests.get(detail_url).json()
-                        time.sleep(0.25)  # Avoid TMDb rate limit (40 requests/10s)
-                        genres = ', '.join(g['name'] for g in detail_response.get('genres', []))
-                        countries = ', '.join(c['name'] for c in detail_response.get('production_countries', []))
-                        movie_language = detail_response.get('original_language', language_code).upper()
-                        country_codes = [c['iso_3166_1'] for c in detail_response.get('production_countries', [])]
-                        if ((not language or language_code == detail_response.get('original_language', '')) and
-                            (not country or region_code in country_codes)):
-                            data.append({
-                                'title': movie['title'],
-                                'year': released[:4] if released else datetime.now().strftime('%Y'),
-                                'rating': float(movie.get('vote_average', 0)),
-                                'genre': genres,
-                                'released': released,
-                                'language': movie_language,
-                                'country': countries
-                            })
-                            print(f"Added {movie['title']} ({released})")
-                        else:
-                            print(f"Skipped {movie['title']}: Language or country mismatch")
-                    else:
-                        print(f"Skipped {movie['title']}: Invalid release date")
-                except Exception as e:
-                    print(f"Error fetching details for {movie['title']}: {e}")
+                released = movie.get('release_date', '')
+                if is_target_month(released, target_months):
+                    data.append({
+                        'title': movie['title'],
+                        'year': released[:4] if released else datetime.now().strftime('%Y'),
+                        'rating': float(movie.get('vote_average', 0)),
+                        'genre': ', '.join(genre_names[gid] for gid in movie.get('genre_ids', []) if gid in genre_names),
+                        'released': released,
+                        'language': movie.get('original_language', language_code).upper(),
+                        'country': region_code
+                    })
+                    print(f"Added {movie['title']} ({released})")
+                else:
+                    print(f"Skipped {movie['title']}: Invalid release date")
             total_pages = response.get('total_pages', 1)
             print(f"Total pages: {total_pages}")
             if page >= total_pages:
@@ -153,14 +280,13 @@ def fetch_movie_data(language=None, country=None, use_fallback=False):
             print(f"Error fetching /discover/movie: {e}")
             break
 
-    df = pd.DataFrame(data)
+    df = pd.DataFrame(data, columns=MOVIE_COLUMNS).astype({'rating': 'float64'})
     if not df.empty:
-        df = df.dropna(subset=['title', 'rating'])
-        df['rating'] = df['rating'].astype(float)
-        df = df.drop_duplicates(subset=['title'])
+        df = df[df['title'].notna() & df['rating'].notna()].drop_duplicates('title', ignore_index=True)
         print(f"Fetched {len(df)} movies")
-        df.to_csv(cache_file, index=False)
-        print("Saved to movies.csv")
+        df = df.astype(MOVIE_DTYPES)
+        df.to_feather(cache_file, compression='uncompressed')
+        print("Saved to movies.feather")
     else:
         print("No valid movies found")
     return df
@@ -168,10 +294,10 @@ def fetch_movie_data(language=None, country=None, use_fallback=False):
 def get_recommendations(df, n=4):
     """Return top n movies by rating."""
     print(f"Selecting top {n} movies")
-    if df.empty or not all(col in df.columns for col in ['title', 'rating']):
+    if df.empty or not _RECOMMENDATION_COLS.issubset(df.columns):
         print("Invalid DataFrame: Empty or missing title/rating columns")
         return []
-    return df.sort_values('rating', ascending=False).head(n)[['title', 'rating']].to_dict('records')
+    return df.nlargest(n, 'rating')[['title', 'rating']].to_dict('records')
 
 async def recommend_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the /recommend conversation, ask for language."""
@@ -184,7 +310,8 @@ async def recommend_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def recommend_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Store language and ask for country."""
     context.user_data['language'] = update.message.text.strip()
-    print(f"User selected language: {context.user_data['language']}")
+    context.user_data['language_code'] = LANGUAGE_MAP.get(context.user_data['language'].lower(), 'en')
+    print(f"User selected language: {context.user_data['language']} ({context.user_data['language_code']})")
     await update.effective_chat.send_message(
         "Which country would you like the movies to be from? (e.g., USA, UK)"
     )
@@ -193,12 +320,16 @@ async def recommend_language(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def recommend_country(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Fetch movies based on language and country, display recommendations."""
     context.user_data['country'] = update.message.text.strip()
-    print(f"User selected country: {context.user_data['country']}")
+    context.user_data['region_code'] = COUNTRY_MAP.get(context.user_data['country'].lower(), 'US')
+    print(f"User selected country: {context.user_data['country']} ({context.user_data['region_code']})")
     language = context.user_data.get('language')
     country = context.user_data.get('country')
+    language_code = context.user_data.get('language_code', 'en')
+    region_code = context.user_data['region_code']
+    force_refresh = context.user_data.pop('force_refresh', False)
 
     # Try current and next month
-    df = fetch_movie_data(language, country, use_fallback=False)
+    df = await fetch_movie_data(language_code, region_code, use_fallback=False, force_refresh=force_refresh)
     month_range = INITIAL_MONTHS
     if len(df) < 4:
         print(f"Insufficient movies for {', '.join(month_range)}: {len(df)}")
@@ -206,7 +337,7 @@ async def recommend_country(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Only {len(df)} movies found for {', '.join(month_range)} in {language} from {country}. "
             f"Searching movies from {FALLBACK_MONTHS[0]} onward..."
         )
-        df = fetch_movie_data(language, country, use_fallback=True)
+        df = await fetch_movie_data(language_code, region_code, use_fallback=True, force_refresh=force_refresh)
         month_range = FALLBACK_MONTHS
         if len(df) < 4:
             await update.effective_chat.send_message(
@@ -243,11 +374,28 @@ async def recommend_country(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Created poll with ID {message.poll.id}")
     return ConversationHandler.END
 
+async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Let the admin bypass the movie and TMDb caches on their next /recommend."""
+    if not ADMIN_USER_ID or str(update.effective_user.id) != ADMIN_USER_ID:
+        await update.effective_chat.send_message("Only the bot admin can refresh the movie cache.")
+        return
+    context.user_data['force_refresh'] = True
+    print(f"Cache refresh requested by admin {update.effective_user.id}")
+    await update.effective_chat.send_message("Your next /recommend will fetch fresh data from TMDb.")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the conversation."""
     await update.effective_chat.send_message("Recommendation process cancelled.")
     return ConversationHandler.END
 
+@lru_cache(maxsize=None)
+def load_plotting():
+    """Import matplotlib.pyplot with the headless Agg backend on first use."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 async def poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle poll votes and send bar chart."""
     poll = update.poll
@@ -258,25 +406,30 @@ async def poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Collect vote data
     votes = {option.text: option.voter_count for option in poll.options}
-    df_votes = pd.DataFrame(list(votes.items()), columns=['Movie', 'Votes'])
     print(f"Poll results: {votes}")
 
-    # Generate and save bar chart
-    plt.figure(figsize=(8, 5))
-    sns.barplot(x='Votes', y='Movie', data=df_votes, hue='Movie', palette='viridis', legend=False)
-    plt.title('Movie Poll Results')
-    plt.xlabel('Number of Votes')
-    plt.ylabel('Movie')
-    plt.tight_layout()
-    os.makedirs('images', exist_ok=True)
-    plt.savefig('images/poll_results.png')
-    plt.close()
-    print("Saved poll_results.png")
+    # Generate bar chart
+    plt = load_plotting()
+    fig, ax = plt.subplots(figsize=(8, 5))
+    colors = [plt.cm.viridis(i / max(len(votes) - 1, 1)) for i in range(len(votes))]
+    ax.barh(list(votes.keys()), list(votes.values()), color=colors)
+    ax.invert_yaxis()  # First poll option on top
+    ax.set_title('Movie Poll Results')
+    ax.set_xlabel('Number of Votes')
+    ax.set_ylabel('Movie')
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    buf.seek(0)
 
     # Send the image
-    with open('images/poll_results.png', 'rb') as image_file:
-        await context.bot.send_photo(chat_id=chat_id, photo=image_file)
-        print(f"Sent poll results to chat {chat_id}")
+    await context.bot.send_photo(chat_id=chat_id, photo=buf)
+    print(f"Sent poll results to chat {chat_id}")
+
+    # No further updates arrive once the poll is closed
+    if poll.is_closed:
+        poll_id_to_chat_id.pop(poll.id, None)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors."""
@@ -288,7 +441,13 @@ def main():
     """Run the bot."""
     print("Starting bot...")
     try:
-        app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        app = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .post_init(preload_genre_names)
+            .post_shutdown(close_tmdb_session)
+            .build()
+        )
         conv_handler = ConversationHandler(
             entry_points=[CommandHandler('recommend', recommend_start)],
             states={
@@ -298,6 +457,7 @@ def main():
             fallbacks=[CommandHandler('cancel', cancel)]
         )
         app.add_handler(conv_handler)
+        app.add_handler(CommandHandler('refresh', refresh))
         app.add_handler(PollHandler(poll_answer))
         app.add_error_handler(error_handler)
         print("Bot initialized, starting polling...")